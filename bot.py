@@ -1,12 +1,16 @@
+import io
 import os
 import logging
 import asyncio
 import uuid
-from google.api_core.client_options import ClientOptions
-from google.cloud import documentai
+import time
+import hashlib
+import functools
+import itertools
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton, InputFile
 from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters, CallbackContext
-from docx import Document
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -17,272 +21,666 @@ LOCATION = os.getenv("LOCATION")
 PROCESSOR_ID = os.getenv("PROCESSOR_ID")
 GOOGLE_CREDENTIALS = os.getenv("GOOGLE_CREDENTIALS")
 SUMMARIZER_PROCESSOR_ID = os.getenv("SUMMARIZER_PROCESSOR_ID")
+BATCH_GCS_URI = os.getenv("BATCH_GCS_URI")  # Optional, gs://bucket/prefix enables batch mode
 
 
 os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = GOOGLE_CREDENTIALS
 
-# Create directories if they don't exist
-os.makedirs("downloads", exist_ok=True)
-os.makedirs("outputs", exist_ok=True)
-
 # Logging Configuration
 logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
 
+# Shared async Document AI client, created on first use inside the running event loop.
+# Document AI and python-docx are imported lazily, /start never pays for protobuf, gRPC or lxml.
+_client = None
+# Keepalive pings detect dead connections during in-flight calls (no pings while idle,
+# Google front ends reject frequent idle pings); never cap the size of large OCR responses
+_GRPC_OPTIONS = [
+    ("grpc.keepalive_time_ms", 30_000),
+    ("grpc.keepalive_timeout_ms", 10_000),
+    ("grpc.max_send_message_length", -1),
+    ("grpc.max_receive_message_length", -1),
+]
+_OCR_PATH = f"projects/{PROJECT_ID}/locations/{LOCATION}/processors/{PROCESSOR_ID}"
+_SUM_PATH = f"projects/{PROJECT_ID}/locations/{LOCATION}/processors/{SUMMARIZER_PROCESSOR_ID}"
+
+# Maximum in-flight Document AI requests, sized to the processor quota
+DOCAI_MAX_CONCURRENCY = 8
+_DOCAI_SEMAPHORE = asyncio.Semaphore(DOCAI_MAX_CONCURRENCY)
+
+# Keys for texts stored in user_data: a random per-process prefix plus a counter,
+# so buttons from before a restart never resolve to a new document
+_KEY_PREFIX = os.urandom(3).hex()
+_KEY_SEQ = itertools.count()
+# Number of processed documents kept per user for the output buttons
+USER_STORE_MAX_SIZE = 256
+# Uploads can be up to 20 MB, so the store is also capped by the bytes it holds
+USER_STORE_MAX_BYTES = 32 * 1024 * 1024
+
+# Longer texts are sent as a file only, chunking them would flood the chat
+MAX_CHAT_TEXT_LENGTH = 40 * 1024
+
+# Output menus as (label, callback option) rows
+_OUTPUT_MENU = (
+    (("📩 Message", "output_message"), ("📄 TXT File", "output_txt")),
+    (("📄+📩 TXT & Message", "output_both"), ("📜 Word File (DOCX)", "output_docx")),
+    (("📝 Summarize Document", "output_summarize"),),
+)
+_SUMMARY_MENU = (
+    (("📩 Message", "summary_message"), ("📄 TXT File", "summary_txt")),
+    (("📜 Word File (DOCX)", "summary_docx"),),
+)
+
+# DOCX serialization is blocking, it runs on its own small pool
+_DOCX_POOL = ThreadPoolExecutor(max_workers=4, thread_name_prefix="docx")
+
+# PDFs longer than this are split into shards and recognized concurrently
+PDF_SHARD_THRESHOLD = 4
+PDF_SHARD_PAGES = 4
+
+# Batch mode: uploads arriving within the window are sent as one batch request
+BATCH_WINDOW_SECONDS = 5
+BATCH_MAX_FILES = 16
+BATCH_TIMEOUT_SECONDS = 10 * 60
+_batch_pending = []
+_batch_timer = None
+_batch_tasks = set()
+_storage_client = None
+
+# Extensions accepted before download and file signatures of the supported formats
+_SUPPORTED_EXTS = frozenset({".jpg", ".jpeg", ".png", ".pdf"})
+_MAGIC = {
+    b"\x89PNG": "image/png",
+    b"\xff\xd8\xff": "image/jpeg",
+    b"%PDF": "application/pdf",
+}
+
+# Memo cache for Document AI results, keyed on the content hash (duplicate uploads skip the RPC)
+MEMO_MAX_SIZE = 512
+MEMO_TTL_SECONDS = 60 * 60
+_MEMO = OrderedDict()
+
+
+def _memo_get(key):
+    """Returns a cached result or None if missing/expired"""
+    entry = _MEMO.get(key)
+    if entry is None:
+        return None
+
+    stored_at, value = entry
+    if time.monotonic() - stored_at > MEMO_TTL_SECONDS:
+        del _MEMO[key]
+        return None
+
+    _MEMO.move_to_end(key)
+    return value
+
+
+def _memo_put(key, value) -> None:
+    """Stores a result, evicting the least recently used entries"""
+    _MEMO[key] = (time.monotonic(), value)
+    _MEMO.move_to_end(key)
+    while len(_MEMO) > MEMO_MAX_SIZE:
+        _MEMO.popitem(last=False)
+
+
+class _LRU(OrderedDict):
+    """OrderedDict that drops the least recently stored entries past maxsize or maxbytes"""
+
+    def __init__(self, maxsize: int, maxbytes: int, sizeof):
+        super().__init__()
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.sizeof = sizeof
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.move_to_end(key)
+        while len(self) > self.maxsize:
+            self.popitem(last=False)
+        # The newest entry is always kept, even if it alone exceeds maxbytes
+        while len(self) > 1 and sum(self.sizeof(v) for v in self.values()) > self.maxbytes:
+            self.popitem(last=False)
+
+
+def _entry_size(entry) -> int:
+    """Approximate memory held by a stored document"""
+    size = len(entry["file"][0]) if entry["file"] else 0
+    for key in ("text", "summary"):
+        if entry[key]:
+            size += len(entry[key])
+    return size
+
+
+def _release_file(entry) -> None:
+    """Drops the upload once text and summary exist, nothing reads it after that"""
+    if entry["text"] is not None and "❌" not in entry["text"] and entry["summary"] is not None:
+        entry["file"] = None
+
+
+def _user_store(context: CallbackContext) -> _LRU:
+    """Per-user store of processed documents, keyed by text_key"""
+    return context.user_data.setdefault("_ocr_lru", _LRU(USER_STORE_MAX_SIZE, USER_STORE_MAX_BYTES, _entry_size))
+
+
+def _menu(rows, text_key: str) -> InlineKeyboardMarkup:
+    """Builds an inline keyboard for the given menu rows and text key"""
+    return InlineKeyboardMarkup(
+        [[InlineKeyboardButton(label, callback_data=f"{option}|{text_key}") for label, option in row] for row in rows]
+    )
+
 
 async def start(update: Update, context: CallbackContext) -> None:
     """Start Command"""
     await update.message.reply_text("👋 Send me an image or a PDF, and I'll extract the text! You can choose the output format.")
 
 
-def process_document(file_path: str) -> str:
-    """Processes a document using Google Document AI"""
-    client_options = ClientOptions(api_endpoint=f"{LOCATION}-documentai.googleapis.com")
-    client = documentai.DocumentProcessorServiceClient(client_options=client_options)
+def is_supported_file_name(file_name: str) -> bool:
+    """Checks the file extension, the MIME type itself comes from the magic bytes"""
+    return os.path.splitext(file_name)[1].lower() in _SUPPORTED_EXTS
 
-    processor_path = f"projects/{PROJECT_ID}/locations/{LOCATION}/processors/{PROCESSOR_ID}"
 
-    with open(file_path, "rb") as image:
-        image_content = image.read()
+def sniff_mime_type(content: bytes):
+    """Detects the MIME type from the leading magic bytes, None if unsupported"""
+    return next((mime_type for magic, mime_type in _MAGIC.items() if content.startswith(magic)), None)
 
-    # Detect correct MIME type
-    if file_path.endswith((".jpg", ".jpeg", ".png")):
-        mime_type = "image/jpeg"
-    elif file_path.endswith(".pdf"):
-        mime_type = "application/pdf"
-    else:
-        return "❌ Unsupported file format."
+
+def split_pdf(content: bytes) -> list:
+    """Splits a PDF into page-range shards, keeps small PDFs whole"""
+    try:
+        import fitz  # PyMuPDF, optional
+    except ImportError:
+        return [content]
+
+    with fitz.open(stream=content, filetype="pdf") as pdf:
+        if pdf.page_count <= PDF_SHARD_THRESHOLD:
+            return [content]
+
+        shards = []
+        for start in range(0, pdf.page_count, PDF_SHARD_PAGES):
+            end = min(start + PDF_SHARD_PAGES, pdf.page_count) - 1
+            with fitz.open() as shard:
+                shard.insert_pdf(pdf, from_page=start, to_page=end)
+                shards.append(shard.tobytes())
+        return shards
+
+
+def _get_client():
+    """Returns the shared async Document AI client"""
+    global _client
+    if _client is None:
+        from google.cloud import documentai
+        from google.cloud.documentai_v1.services.document_processor_service.transports import (
+            DocumentProcessorServiceGrpcAsyncIOTransport,
+        )
+
+        endpoint = f"{LOCATION}-documentai.googleapis.com"
+        channel = DocumentProcessorServiceGrpcAsyncIOTransport.create_channel(f"{endpoint}:443", options=_GRPC_OPTIONS)
+        transport = DocumentProcessorServiceGrpcAsyncIOTransport(host=endpoint, channel=channel)
+        _client = documentai.DocumentProcessorServiceAsyncClient(transport=transport)
+    return _client
+
+
+async def process_document(image_content: bytes, mime_type: str) -> str:
+    """Processes a document using Google Document AI"""
+    from google.cloud import documentai
 
     # Form request
     raw_document = documentai.RawDocument(content=image_content, mime_type=mime_type)
-    request = documentai.ProcessRequest(name=processor_path, raw_document=raw_document)
+    request = documentai.ProcessRequest(name=_OCR_PATH, raw_document=raw_document)
 
     # Process document
-    result = client.process_document(request=request)
+    async with _DOCAI_SEMAPHORE:
+        result = await _get_client().process_document(request=request)
     document = result.document
-    extracted_text = document.text
+    return document.text
+
+
+def _get_storage_client():
+    """Creates the Cloud Storage client on first use (batch mode only)"""
+    global _storage_client
+    if _storage_client is None:
+        from google.cloud import storage
+
+        _storage_client = storage.Client()
+    return _storage_client
+
+
+def _upload_batch_inputs(bucket, batch_prefix: str, documents: list) -> list:
+    """Uploads batch inputs to Cloud Storage and returns their URIs"""
+    input_uris = []
+    for index, (content, mime_type) in enumerate(documents):
+        blob = bucket.blob(f"{batch_prefix}/input/{index:04d}")
+        blob.upload_from_string(content, content_type=mime_type)
+        input_uris.append(f"gs://{bucket.name}/{blob.name}")
+    return input_uris
+
+
+def _read_batch_outputs(bucket, metadata) -> dict:
+    """Reads output JSON shards back, in order, for every input document (an exception if it failed)"""
+    from google.cloud import documentai
+
+    texts = {}
+    for status in metadata.individual_process_statuses:
+        if status.status.code != 0:
+            logging.error(f"Batch processing failed for {status.input_gcs_source}: {status.status.message}")
+            texts[status.input_gcs_source] = RuntimeError(f"Batch processing failed: {status.status.message}")
+            continue
+
+        # Slash-terminated, so input 1 does not also match the outputs of inputs 10-15
+        output_prefix = status.output_gcs_destination.removeprefix(f"gs://{bucket.name}/").rstrip("/") + "/"
+        shards = [
+            documentai.Document.from_json(blob.download_as_bytes(), ignore_unknown_fields=True)
+            for blob in bucket.list_blobs(prefix=output_prefix)
+            if blob.name.endswith(".json")
+        ]
+        # Shard names sort as text (-10 before -2), order by the shard index instead
+        shards.sort(key=lambda document: document.shard_info.shard_index)
+        texts[status.input_gcs_source] = "".join(document.text for document in shards)
+    return texts
+
+
+def _delete_batch_files(bucket, batch_prefix: str) -> None:
+    """Removes batch inputs and outputs, they are only needed during the request"""
+    try:
+        bucket.delete_blobs(list(bucket.list_blobs(prefix=batch_prefix)))
+    except Exception as e:
+        logging.warning(f"Failed to clean up batch files: {e}")
+
+
+async def batch_process_documents(documents: list) -> list:
+    """Recognizes (content, mime_type) pairs with one GCS-backed batch request.
+
+    Returns a text per document, or the exception for documents that failed.
+    """
+    from google.cloud import documentai
+
+    bucket_name, _, prefix = BATCH_GCS_URI.removeprefix("gs://").partition("/")
+    bucket = _get_storage_client().bucket(bucket_name)
+    batch_prefix = f"{prefix.strip('/')}/batch/{uuid.uuid4().hex}".lstrip("/")
+
+    # Cloud Storage client is blocking, keep it off the event loop
+    input_uris = await asyncio.to_thread(_upload_batch_inputs, bucket, batch_prefix, documents)
+
+    try:
+        # Form request
+        gcs_documents = documentai.GcsDocuments(
+            documents=[
+                documentai.GcsDocument(gcs_uri=uri, mime_type=mime_type)
+                for uri, (_, mime_type) in zip(input_uris, documents)
+            ]
+        )
+        request = documentai.BatchProcessRequest(
+            name=_OCR_PATH,
+            input_documents=documentai.BatchDocumentsInputConfig(gcs_documents=gcs_documents),
+            document_output_config=documentai.DocumentOutputConfig(
+                gcs_output_config=documentai.DocumentOutputConfig.GcsOutputConfig(
+                    gcs_uri=f"gs://{bucket_name}/{batch_prefix}/output/"
+                )
+            ),
+        )
+
+        # Process documents and wait for the long-running operation
+        async with _DOCAI_SEMAPHORE:
+            operation = await _get_client().batch_process_documents(request=request)
+        await operation.result(timeout=BATCH_TIMEOUT_SECONDS)
+        metadata = documentai.BatchProcessMetadata(operation.metadata)
+
+        texts = await asyncio.to_thread(_read_batch_outputs, bucket, metadata)
+        return [texts.get(uri, RuntimeError(f"No batch processing status for {uri}")) for uri in input_uris]
+
+    finally:
+        await asyncio.to_thread(_delete_batch_files, bucket, batch_prefix)
+
+
+async def _flush_batch(items: list) -> None:
+    """Runs one batch request and resolves the waiting handlers"""
+    try:
+        texts = await batch_process_documents([(content, mime_type) for content, mime_type, _ in items])
+        for (_, _, future), text in zip(items, texts):
+            if future.done():
+                continue
+            # A failed document raises in its own handler, so "no text" is never memoized for it
+            if isinstance(text, Exception):
+                future.set_exception(text)
+            else:
+                future.set_result(text)
+    except Exception as e:
+        for _, _, future in items:
+            if not future.done():
+                future.set_exception(e)
+
+
+def _start_batch_flush() -> None:
+    """Hands the pending uploads over to a background batch task"""
+    global _batch_pending, _batch_timer
+    if _batch_timer is not None:
+        _batch_timer.cancel()
+        _batch_timer = None
+
+    items, _batch_pending = _batch_pending, []
+    if not items:
+        return
 
-    return extracted_text if extracted_text.strip() else "❌ No text recognized."
+    task = asyncio.create_task(_flush_batch(items))
+    _batch_tasks.add(task)
+    task.add_done_callback(_batch_tasks.discard)
 
 
-def summarize_document(file_path: str) -> str:
-    """Summarizes a document using Google Document AI Summarizer"""
-    client_options = ClientOptions(api_endpoint=f"{LOCATION}-documentai.googleapis.com")
-    client = documentai.DocumentProcessorServiceClient(client_options=client_options)
+async def batch_extract_text(content: bytes, mime_type: str) -> str:
+    """Queues a file for the next batch request and waits for its text"""
+    global _batch_timer
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+    _batch_pending.append((content, mime_type, future))
 
-    processor_path = f"projects/{PROJECT_ID}/locations/{LOCATION}/processors/{SUMMARIZER_PROCESSOR_ID}"
+    if len(_batch_pending) >= BATCH_MAX_FILES:
+        _start_batch_flush()
+    elif _batch_timer is None:
+        _batch_timer = loop.call_later(BATCH_WINDOW_SECONDS, _start_batch_flush)
 
-    with open(file_path, "rb") as document_file:
-        document_content = document_file.read()
+    return await future
 
-    # Detect correct MIME type
-    if file_path.endswith((".jpg", ".jpeg", ".png")):
-        mime_type = "image/jpeg"
-    elif file_path.endswith(".pdf"):
-        mime_type = "application/pdf"
+
+async def extract_text(content: bytes, mime_type: str) -> str:
+    """Extracts text, recognizing large PDFs shard by shard in parallel"""
+    # Same bytes were already recognized recently
+    memo_key = ("ocr", hashlib.sha256(content).digest(), mime_type)
+    cached = _memo_get(memo_key)
+    if cached is not None:
+        return cached
+
+    if BATCH_GCS_URI:
+        extracted_text = await batch_extract_text(content, mime_type)
     else:
-        return "❌ Unsupported file format."
+        if mime_type == "application/pdf":
+            shards = await asyncio.to_thread(split_pdf, content)
+        else:
+            shards = [content]
+
+        # gather keeps the results in shard order
+        texts = await asyncio.gather(*(process_document(shard, mime_type) for shard in shards))
+        # Each shard's text already ends with a line break
+        extracted_text = "".join(texts)
+
+    extracted_text = extracted_text if extracted_text.strip() else "❌ No text recognized."
+    _memo_put(memo_key, extracted_text)
+    return extracted_text
+
+
+async def summarize_document(text: str) -> str:
+    """Summarizes already extracted text using Google Document AI Summarizer"""
+    from google.cloud import documentai
+
+    content = text.encode("utf-8")
+
+    memo_key = ("summary", hashlib.sha256(content).digest(), "text/plain")
+    cached = _memo_get(memo_key)
+    if cached is not None:
+        return cached
+
+    raw_document = documentai.RawDocument(content=content, mime_type="text/plain")
+    summary = await _summarize_raw_document(raw_document)
+    _memo_put(memo_key, summary)
+    return summary
+
+
+async def summarize_file(document_content: bytes, mime_type: str) -> str:
+    """Summarizes the original file (fallback when plain text is refused)"""
+    from google.cloud import documentai
+
+    memo_key = ("summary", hashlib.sha256(document_content).digest(), mime_type)
+    cached = _memo_get(memo_key)
+    if cached is not None:
+        return cached
 
-    # Form request
     raw_document = documentai.RawDocument(content=document_content, mime_type=mime_type)
-    request = documentai.ProcessRequest(name=processor_path, raw_document=raw_document)
+    summary = await _summarize_raw_document(raw_document)
+    _memo_put(memo_key, summary)
+    return summary
+
+
+async def _summarize_raw_document(raw_document) -> str:
+    """Sends a raw document to the summarizer and extracts the summary"""
+    from google.cloud import documentai
+
+    # Form request
+    request = documentai.ProcessRequest(name=_SUM_PATH, raw_document=raw_document)
 
     # Process document
-    result = client.process_document(request=request)
+    async with _DOCAI_SEMAPHORE:
+        result = await _get_client().process_document(request=request)
     document = result.document
 
-    # Extract summary from the processed document
-    summary = ""
-    for entity in document.entities:
-        if entity.type_ == "summary":
-            summary += entity.mention_text + "\n"
-
-    if not summary:
-        # If no specific summary entity is found, use the text field
-        summary = document.text
+    # Extract summary from the processed document, falling back to the text field
+    summary = "\n".join(entity.mention_text for entity in document.entities if entity.type_ == "summary") or document.text
 
     return summary if summary.strip() else "❌ No summary could be generated."
 
-def save_as_docx(text, file_name="output.docx"):
-    """Saves extracted text as a DOCX file"""
-    doc_path = f"outputs/{file_name}"
+def save_as_docx(text) -> bytes:
+    """Saves extracted text as DOCX file contents"""
+    from docx import Document
+
+    buffer = io.BytesIO()
     doc = Document()
     doc.add_paragraph(text)
-    doc.save(doc_path)
-    return doc_path
+    doc.save(buffer)
+    return buffer.getvalue()
+
 
+async def build_docx(text) -> bytes:
+    """Builds DOCX file contents without blocking the event loop"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_DOCX_POOL, save_as_docx, text)
 
-async def send_text_chunks(update: Update, text: str, chunk_size=4096):
+
+async def send_text_chunks(message, text: str, chunk_size=4096):
     """Splits and sends text in chunks to avoid Telegram's message limit"""
+    # Sent one by one, Telegram orders messages by arrival
     for i in range(0, len(text), chunk_size):
-        await update.effective_message.reply_text(text[i : i + chunk_size])
+        await message.reply_text(text[i : i + chunk_size])
 
 
-async def send_output_options(update: Update, context: CallbackContext, text: str):
+async def send_output_options(update: Update, context: CallbackContext, original_file):
     """Sends output format selection buttons"""
-    text_key = str(uuid.uuid4())[:8]  # Create an 8-character unique key
-    context.user_data[text_key] = text  # Store text in context memory
-
-    # Store the file path in context for summarization
-    if "current_file_path" in context.user_data:
-        context.user_data[f"file_path_{text_key}"] = context.user_data["current_file_path"]
-
-    keyboard = [
-        [
-            InlineKeyboardButton("📩 Message", callback_data=f"output_message|{text_key}"),
-            InlineKeyboardButton("📄 TXT File", callback_data=f"output_txt|{text_key}"),
-        ],
-        [
-            InlineKeyboardButton("📄+📩 TXT & Message", callback_data=f"output_both|{text_key}"),
-            InlineKeyboardButton("📜 Word File (DOCX)", callback_data=f"output_docx|{text_key}"),
-        ],
-        [
-            InlineKeyboardButton("📝 Summarize Document", callback_data=f"output_summarize|{text_key}"),
-        ]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await update.effective_message.reply_text("📝 Choose an output format:", reply_markup=reply_markup)
+    text_key = f"{_KEY_PREFIX}.{next(_KEY_SEQ):x}"  # Create a short unique key
+    # Store the file with its (not yet extracted) text and summary, so they are evicted together
+    _user_store(context)[text_key] = {
+        "file": original_file,
+        "text": None,
+        "summary": None,
+        "lock": asyncio.Lock(),
+        "summary_lock": asyncio.Lock(),
+    }
+
+    await update.effective_message.reply_text("📝 Choose an output format:", reply_markup=_menu(_OUTPUT_MENU, text_key))
 
 async def handle_document(update: Update, context: CallbackContext) -> None:
     """Handles document/photo processing"""
     file = update.message.document or update.message.photo[-1]  # Get file
     file_id = file.file_id
-    file_name = f"downloads/{file_id}.jpg" if update.message.photo else f"downloads/{file.file_name}"
+    file_name = f"{file_id}.jpg" if update.message.photo else file.file_name or ""
+
+    # Cheap check on the name before downloading anything
+    if not is_supported_file_name(file_name):
+        await update.effective_message.reply_text("❌ Unsupported file format.")
+        return
 
     try:
-        # Download file asynchronously
+        # Download file straight into memory
         new_file = await context.bot.get_file(file_id)
-        await new_file.download_to_drive(file_name)
+        content = bytes(await new_file.download_as_bytearray())
 
-        # Store the file path in context for later use
-        context.user_data["current_file_path"] = file_name
-
-        await update.effective_message.reply_text("🔄 Processing file, please wait...")
-
-        # Process using Google Document AI (Synchronously for faster execution)
-        loop = asyncio.get_running_loop()
-        extracted_text = await loop.run_in_executor(None, process_document, file_name)
-
-        # If no text found, notify the user
-        if "❌" in extracted_text:
-            await update.effective_message.reply_text(extracted_text)
+        # The actual bytes decide the MIME type (a .png is not a JPEG)
+        mime_type = sniff_mime_type(content)
+        if mime_type is None:
+            await update.effective_message.reply_text("❌ Unsupported file format.")
             return
 
-        # Offer output options
-        await send_output_options(update, context, extracted_text)
+        # Offer output options, OCR only runs once a format that needs it is picked
+        await send_output_options(update, context, (content, mime_type))
 
     except Exception as e:
         logging.error(f"Error processing file: {e}")
         await update.effective_message.reply_text("❌ An error occurred while processing the document. Please try again!")
 
 
-async def handle_output_choice(update: Update, context: CallbackContext) -> None:
-    """Handles the output choice from inline buttons"""
-    query = update.callback_query
-    await query.answer()
+async def get_extracted_text(query, entry) -> str:
+    """Runs OCR for a stored file once, later picks reuse the result"""
+    async with entry["lock"]:
+        if entry["text"] is None:
+            await query.message.reply_text("🔄 Processing file, please wait...")
+            entry["text"] = await extract_text(*entry["file"])
+            _release_file(entry)
+        return entry["text"]
 
-    try:
-        option, text_key = query.data.split("|")
-        extracted_text = context.user_data.get(text_key, "")
 
-        if not extracted_text:
-            await query.message.reply_text("❌ Error retrieving processed text.")
+def _with_extracted_text(send):
+    """Wraps a sender so it receives the extracted text (OCR runs on first use)"""
+    @functools.wraps(send)
+    async def handler(query, entry, text_key):
+        extracted_text = await get_extracted_text(query, entry)
+
+        # If no text found, notify the user
+        if "❌" in extracted_text:
+            await query.message.reply_text(extracted_text)
             return
 
-        txt_path = f"outputs/{text_key}.txt"
-        docx_path = f"outputs/{text_key}.docx"
+        await send(query, extracted_text)
+    return handler
 
-        # Handle summarize option
-        if option == "output_summarize":
-            # Get the file path from context
-            file_path = context.user_data.get(f"file_path_{text_key}")
 
-            if not file_path:
-                await query.message.reply_text("❌ Cannot find the original file for summarization.")
-                return
+def _with_summary(send):
+    """Wraps a sender so it receives the stored summary"""
+    @functools.wraps(send)
+    async def handler(query, entry, text_key):
+        summary = entry["summary"]
+
+        if not summary:
+            await query.message.reply_text("❌ Error retrieving summary.")
+            return
 
+        await send(query, summary)
+    return handler
+
+
+async def summarize(query, entry, text_key):
+    """Summarizes a stored document and offers output options for the summary"""
+    from google.api_core.exceptions import InvalidArgument
+
+    # Repeated taps share one summarizer call
+    async with entry["summary_lock"]:
+        if entry["summary"] is None:
             await query.message.reply_text("🔄 Summarizing document, please wait...")
 
-            # Process using Google Document AI Summarizer
-            loop = asyncio.get_running_loop()
-            summary = await loop.run_in_executor(None, summarize_document, file_path)
+            extracted_text = entry["text"]
+            if extracted_text is None or "❌" in extracted_text:
+                # No OCR was needed so far, the summarizer reads the original file
+                summary = await summarize_file(*entry["file"])
+            else:
+                # Summarize the already extracted text instead of uploading the file again
+                try:
+                    summary = await summarize_document(extracted_text)
+                except InvalidArgument as e:
+                    # The processor refused text/plain, fall back to the original file
+                    logging.warning(f"Summarizer rejected plain text, using original file: {e}")
+                    summary = await summarize_file(*entry["file"])
 
             if "❌" in summary:
                 await query.message.reply_text(summary)
                 return
 
-            # Offer output options for the summary
-            context.user_data[f"summary_{text_key}"] = summary
-
-            summary_keyboard = [
-                [
-                    InlineKeyboardButton("📩 Message", callback_data=f"summary_message|{text_key}"),
-                    InlineKeyboardButton("📄 TXT File", callback_data=f"summary_txt|{text_key}"),
-                ],
-                [
-                    InlineKeyboardButton("📜 Word File (DOCX)", callback_data=f"summary_docx|{text_key}"),
-                ]
-            ]
-            summary_markup = InlineKeyboardMarkup(summary_keyboard)
-            await query.message.reply_text("📝 Choose an output format for the summary:", reply_markup=summary_markup)
-            return
+            entry["summary"] = summary
+            _release_file(entry)
 
-        # Handle summary output formats
-        elif option.startswith("summary_"):
-            summary = context.user_data.get(f"summary_{text_key}", "")
+    # Offer output options for the summary
+    await query.message.reply_text("📝 Choose an output format for the summary:",
+                                   reply_markup=_menu(_SUMMARY_MENU, text_key))
 
-            if not summary:
-                await query.message.reply_text("❌ Error retrieving summary.")
-                return
 
-            summary_path = f"outputs/summary_{text_key}.txt"
-            summary_docx = f"outputs/summary_{text_key}.docx"
+async def _send_chat_text(query, text: str, heading: str, send_file) -> bool:
+    """Sends text as chat messages, or via send_file if too long; True if sent to chat"""
+    if len(text) > MAX_CHAT_TEXT_LENGTH:
+        await query.message.reply_text("📄 Text is too long for chat, sending it as a file.")
+        await send_file(query, text)
+        return False
 
-            # Save summary to TXT file
-            with open(summary_path, "w", encoding="utf-8") as file:
-                file.write(summary)
+    await send_text_chunks(query.message, f"{heading}\n\n{text}")
+    return True
 
-            if option == "summary_message":
-                await send_text_chunks(update, f"📝 **Document Summary:**\n\n{summary}")
 
-            elif option == "summary_txt":
-                with open(summary_path, "rb") as doc:
-                    await query.message.reply_document(InputFile(doc, filename="document_summary.txt"),
-                                                       caption="📄 Here is your document summary.")
+async def send_as_message(query, text: str):
+    """Sends extracted text as chat messages"""
+    await _send_chat_text(query, text, "📜 **Extracted Text:**", send_as_txt)
 
-            elif option == "summary_docx":
-                docx_file_path = save_as_docx(summary, file_name=f"summary_{text_key}.docx")
-                with open(docx_file_path, "rb") as doc:
-                    await query.message.reply_document(InputFile(doc, filename="document_summary.docx"),
-                                                       caption="📜 Here is your document summary as a Word document.")
-            return
 
-        # Original options handling (unchanged)
-        # Save TXT file
-        with open(txt_path, "w", encoding="utf-8") as file:
-            file.write(extracted_text)
+async def send_as_txt(query, text: str):
+    """Sends extracted text as a TXT file"""
+    await query.message.reply_document(InputFile(text.encode("utf-8"), filename="extracted_text.txt"),
+                                       caption="📄 Here is your extracted text file.")
 
-        if option == "output_message":
-            await send_text_chunks(update, f"📜 **Extracted Text:**\n\n{extracted_text}")
 
-        elif option == "output_txt":
-            with open(txt_path, "rb") as doc:
-                await query.message.reply_document(InputFile(doc, filename="extracted_text.txt"),
-                                                   caption="📄 Here is your extracted text file.")
+async def send_as_both(query, text: str):
+    """Sends extracted text as chat messages and a TXT file"""
+    # Too long texts are already sent as a file instead of messages
+    if await _send_chat_text(query, text, "📜 **Extracted Text:**", send_as_txt):
+        await send_as_txt(query, text)
 
-        elif option == "output_both":
-            await send_text_chunks(update, f"📜 **Extracted Text:**\n\n{extracted_text}")
-            with open(txt_path, "rb") as doc:
-                await query.message.reply_document(InputFile(doc, filename="extracted_text.txt"),
-                                                   caption="📄 Here is your extracted text file.")
 
-        elif option == "output_docx":
-            docx_file_path = save_as_docx(extracted_text, file_name=f"{text_key}.docx")
-            with open(docx_file_path, "rb") as doc:
-                await query.message.reply_document(InputFile(doc, filename="extracted_text.docx"),
-                                                   caption="📜 Here is your extracted text as a Word document.")
+async def send_as_docx(query, text: str):
+    """Sends extracted text as a DOCX file"""
+    await query.message.reply_document(InputFile(await build_docx(text), filename="extracted_text.docx"),
+                                       caption="📜 Here is your extracted text as a Word document.")
 
-        else:
+
+async def send_summary_as_message(query, summary: str):
+    """Sends the summary as chat messages"""
+    await _send_chat_text(query, summary, "📝 **Document Summary:**", send_summary_as_txt)
+
+
+async def send_summary_as_txt(query, summary: str):
+    """Sends the summary as a TXT file"""
+    await query.message.reply_document(InputFile(summary.encode("utf-8"), filename="document_summary.txt"),
+                                       caption="📄 Here is your document summary.")
+
+
+async def send_summary_as_docx(query, summary: str):
+    """Sends the summary as a DOCX file"""
+    await query.message.reply_document(InputFile(await build_docx(summary), filename="document_summary.docx"),
+                                       caption="📜 Here is your document summary as a Word document.")
+
+
+# Callback option -> handler(query, entry, text_key)
+_HANDLERS = {
+    "output_message": _with_extracted_text(send_as_message),
+    "output_txt": _with_extracted_text(send_as_txt),
+    "output_both": _with_extracted_text(send_as_both),
+    "output_docx": _with_extracted_text(send_as_docx),
+    "output_summarize": summarize,
+    "summary_message": _with_summary(send_summary_as_message),
+    "summary_txt": _with_summary(send_summary_as_txt),
+    "summary_docx": _with_summary(send_summary_as_docx),
+}
+
+
+async def handle_output_choice(update: Update, context: CallbackContext) -> None:
+    """Handles the output choice from inline buttons"""
+    query = update.callback_query
+    await query.answer()
+
+    try:
+        option, text_key = query.data.split("|")
+
+        handler = _HANDLERS.get(option)
+        if not handler:
             await query.message.reply_text("❌ Invalid option.")
+            return
+
+        entry = _user_store(context).get(text_key)
+        if not entry:
+            await query.message.reply_text("❌ Error retrieving processed text.")
+            return
+
+        await handler(query, entry, text_key)
 
     except Exception as e:
         logging.error(f"Error handling output choice: {e}")